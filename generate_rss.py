@@ -8,18 +8,27 @@ https://daringfireball.net/projects/markdown/
 We also depend on `date`:
 https://www.gnu.org/software/coreutils/manual/html_node/date-invocation.html
 """
+import concurrent.futures
+import contextlib
 import datetime
-import math
+import email.utils
+import functools
+import hashlib
+import heapq
 import os
 import pathlib
+import shutil
 import subprocess
 import sys
+import tempfile
 import time
 import typing
 from xml.etree import ElementTree as ET
 from xml.etree.ElementTree import Element, ElementTree
 
-DATETIME_FORMAT = "%a, %d %b %Y %X %z"
+# Resolved once so each conversion doesn't have to search $PATH again.
+MARKDOWN_COMMAND = [shutil.which("markdown") or "markdown", "--html4tags"]
+CACHE_DIR = pathlib.Path("./.rss-cache/")
 TZ_INFO = datetime.timezone(
     datetime.timedelta(seconds=time.localtime().tm_gmtoff)
 )  # whew
@@ -32,14 +41,16 @@ class InvalidMarkdownFile(Exception):
 class MarkdownFile:
     """A wrapper for a file containing Markdown.
 
-    :param stream: a file-like object that contains the Markdown text.
+    :param stream: a file-like object that contains the Markdown text. It is read in full on
+        construction and not kept around, so the caller can close it immediately.
     """
 
     def __init__(self, stream: typing.TextIO):
-        title_line = stream.readline()
-        _ = stream.readline()
-        date_line = stream.readline()
-        stream.seek(0)
+        body = stream.read()
+        # Only the first three lines are needed; leave the rest of the text unsplit.
+        lines = body.split("\n", 3)
+        title_line = lines[0]
+        date_line = lines[2] if len(lines) > 2 else ""
 
         if not title_line.startswith("# "):
             raise InvalidMarkdownFile("Missing title header")
@@ -47,37 +58,57 @@ class MarkdownFile:
         if not date_line.startswith("## "):
             raise InvalidMarkdownFile("Missing date header")
 
-        self.stream = stream
-        self.title = title_line.lstrip("#").strip()
+        self.body = body
+        self.title = title_line[2:].strip()
 
         try:
-            date = datetime.datetime.fromisoformat(date_line.lstrip("#").strip())
+            date = datetime.datetime.fromisoformat(date_line[3:].strip())
         except ValueError:
             raise InvalidMarkdownFile("Date header is not a valid ISO date")
 
-        self.pub_date = date.combine(date.date(), date.time(), TZ_INFO)
+        self.pub_date = date if date.tzinfo is not None else date.replace(tzinfo=TZ_INFO)
 
-    @property
+    @functools.cached_property
     def content(self) -> str:
-        """The contents of the backing file-like object, converted to Markdown."""
+        """The Markdown text of the file, converted to HTML."""
+        return self.render()
+
+    def render(self) -> str:
+        """Converts the Markdown text of the file to HTML, without memoizing it on `content`.
+
+        Conversions are cached in `CACHE_DIR`, keyed on a hash of `MARKDOWN_COMMAND` and the
+        Markdown text, so unchanged files are not converted again on the next run. Upgrading
+        `markdown` in place doesn't change the key, so delete `CACHE_DIR` by hand after doing so.
+        """
+        key = "\0".join([*MARKDOWN_COMMAND, self.body]).encode()
+        digest = hashlib.blake2b(key, digest_size=16).hexdigest()
+        cache_path = CACHE_DIR / f"{digest}.html"
+
+        # The cache is only an optimisation, so a cache that can't be read or written is treated
+        # as a miss rather than failing the feed.
         try:
-            completed_process = subprocess.run(
-                ["markdown", "--html4tags"],
-                input=self.stream.read(),
-                capture_output=True,
-                check=True,
-                text=True,
-            )
-        except subprocess.CalledProcessError as e:
-            # This is pretty rare - all text can be converted to markdown, so it's not a parsing
-            # error.
-            raise InvalidMarkdownFile(f"Could not convert to Markdown {e.stderr}")
+            with open(cache_path, encoding="utf-8") as fp:
+                return fp.read()
+        except (OSError, UnicodeDecodeError):
+            pass
+
+        html = convert_markdown(self.body)
 
-        return completed_process.stdout
+        try:
+            CACHE_DIR.mkdir(exist_ok=True)
+            fp = tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=CACHE_DIR, delete=False)
+            try:
+                with fp:
+                    fp.write(html)
+                os.replace(fp.name, cache_path)
+            except BaseException:
+                with contextlib.suppress(OSError):
+                    os.unlink(fp.name)
+                raise
+        except OSError:
+            pass
 
-    def close(self) -> None:
-        """Closes the backing file-like object."""
-        return self.stream.close()
+        return html
 
 
 class RssElementTree(ElementTree):
@@ -138,7 +169,7 @@ class RssElementTree(ElementTree):
 
         ET.SubElement(item, "title").text = md_file.title
         ET.SubElement(item, "description").text = md_file.content
-        ET.SubElement(item, "pubDate").text = md_file.pub_date.strftime(DATETIME_FORMAT)
+        ET.SubElement(item, "pubDate").text = email.utils.format_datetime(md_file.pub_date)
         ET.SubElement(item, "link").text = url
         ET.SubElement(item, "guid", attrib={"isPermaLink": "true"}).text = url
 
@@ -148,52 +179,79 @@ class RssElementTree(ElementTree):
 def collect_md_files(
     directory: pathlib.Path, max_files: int | None
 ) -> tuple[dict[pathlib.Path, MarkdownFile], list[str]]:
-    """Collects Markdown files in `directory`, searching recursively.
+    """Collects Markdown files in `directory`, searching recursively. Markdown files are
+    identified by ".md" endings only, and symbolic links are not followed.
 
-    Files are sorted on two fields: first, their publication date, derived from the second line,
-    then by their title, derived from the first line. If a file is lacking either of these, it is
-    omitted with a warning.
+    Files are sorted, newest first, on two fields: first, their publication date, derived from the
+    second line, then by their title, derived from the first line. If a file is lacking either of
+    these, it is omitted with a warning.
 
     :param directory: the directory to recursively search for Markdown files.
     :param max_files: the maximum number of Markdown files to include. Files are sorted on two
         fields: first, their publication date, derived from the second line, then by their title
     """
-    md_files: list[tuple[pathlib.Path, MarkdownFile]] = []
+    # A min-heap of the newest files seen so far, so older files can be dropped as we go. The path
+    # breaks ties, so MarkdownFile objects are never compared.
+    md_files: list[tuple[datetime.datetime, str, str, MarkdownFile]] = []
     skipped = []
-    stack = [directory]
+    stack = [str(directory)]
 
-    target = max_files if max_files else math.inf
-
-    while stack and len(md_files) < target:
+    while stack:
         current = stack.pop()
 
-        for dir_entry in os.scandir(current):
-            path = pathlib.Path(dir_entry.path)
-
-            if dir_entry.is_dir():
-                stack.append(path)
-                continue
-
-            try:
-                fp = open(path)
-                md_files.append((path, MarkdownFile(fp)))
-            except InvalidMarkdownFile as e:
-                skipped.append(f"Skipped {path}: {e}")
-
-            if len(md_files) >= target:
-                break
-
-    md_files.sort()
+        with os.scandir(current) as dir_entries:
+            for dir_entry in dir_entries:
+                if dir_entry.is_dir(follow_symlinks=False):
+                    stack.append(dir_entry.path)
+                    continue
+
+                if not (
+                    dir_entry.name.endswith(".md") and dir_entry.is_file(follow_symlinks=False)
+                ):
+                    continue
+
+                try:
+                    with open(dir_entry.path) as fp:
+                        md_file = MarkdownFile(fp)
+                except InvalidMarkdownFile as e:
+                    skipped.append(f"Skipped {dir_entry.path}: {e}")
+                    continue
+
+                entry = (md_file.pub_date, md_file.title, dir_entry.path, md_file)
+
+                if not max_files or len(md_files) < max_files:
+                    heapq.heappush(md_files, entry)
+                else:
+                    heapq.heappushpop(md_files, entry)
+
+    md_files.sort(reverse=True)
+
+    return {pathlib.Path(path): md_file for _, _, path, md_file in md_files}, skipped
+
+
+def convert_markdown(text: str) -> str:
+    """Converts `text` from Markdown to HTML."""
+    # One process per file, on purpose: Markdown.pl resolves reference-style links across the whole
+    # input, so batching posts into one call would let one post's `[1]` pick up another's URL.
+    try:
+        completed_process = subprocess.run(
+            MARKDOWN_COMMAND,
+            input=text,
+            capture_output=True,
+            check=True,
+            text=True,
+        )
+    except subprocess.CalledProcessError as e:
+        # This is pretty rare - all text can be converted to markdown, so it's not a parsing
+        # error.
+        raise InvalidMarkdownFile(f"Could not convert to Markdown {e.stderr}")
 
-    return dict(md_files), skipped
+    return completed_process.stdout
 
 
 def generate_pub_date() -> str:
     """Generates a properly-formatted publication date based on local time."""
-    now = datetime.datetime.now()
-    now = now.combine(now.date(), now.time(), TZ_INFO)
-
-    return now.strftime(DATETIME_FORMAT)
+    return email.utils.format_datetime(datetime.datetime.now(TZ_INFO))
 
 
 def main(
@@ -231,15 +289,20 @@ def main(
     rss_tree = RssElementTree(title, description, url)
     included_files = []
 
+    # Conversion shells out to `markdown`, so threads are enough to overlap the subprocesses. The
+    # results are stored on `content` here because, before Python 3.12, cached_property computes
+    # under a single lock shared by every instance, which would serialize the conversions again.
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        conversions = {path: executor.submit(md_file.render) for path, md_file in md_files.items()}
+
     for path, md_file in md_files.items():
         try:
+            md_file.content = conversions[path].result()
             rss_tree.append_item(md_file, path)
             included_files.append(path)
         except InvalidMarkdownFile as e:
             errors.append(f"Skipped {path}: {e}")
 
-        md_file.close()
-
     return rss_tree, included_files, errors
 
 